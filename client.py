@@ -1,9 +1,13 @@
 import socket
-import json
+import collections
+import itertools
 import threading
 import logging
+import select
 import time
-from typing import Dict, Any, Callable, Optional
+from typing import Dict, Any, Callable, Deque, List, Optional
+
+from protocol import HEADER, MAX_FRAME_SIZE, SOCKET_BUFFER_SIZE, build_frame, dumps, loads
 
 # Configure logging
 logging.basicConfig(
@@ -13,6 +17,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger("Fusion360_MCP_Client")
 
+# Bytes requested per recv_into() while draining the socket
+RECV_SIZE = 65536
+
+# Most frames handed to the kernel in one gathered write
+MAX_BATCH_FRAMES = 16
+
+# Command events are sent as one columnar batch once this many are queued
+# or the oldest has waited EVENT_FLUSH_INTERVAL seconds
+MAX_BATCH_EVENTS = 64
+EVENT_FLUSH_INTERVAL = 0.01
+
+# sendmsg is unavailable on Windows
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
 class MCPClient:
     """
     Client for interacting with the Master Control Program server for Fusion 360
@@ -25,12 +44,32 @@ class MCPClient:
         self.connected = False
         self.running = False
         self.response_handlers: Dict[str, Callable] = {}
+        # Ids attached to LLM requests so their replies can be told apart
+        self._request_ids = itertools.count(1)
         self.receive_thread = None
+        # Scratch buffer every recv_into() reads into, reused for the
+        # lifetime of the client
+        self._rxbuf = bytearray(RECV_SIZE)
+        self._rxview = memoryview(self._rxbuf)
+        # Frames waiting for the send thread, guarded by _send_cond
+        self._send_queue: Deque[bytes] = collections.deque()
+        self._send_cond = threading.Condition()
+        self.send_thread = None
+        # Pending command events, one list per field, also guarded by
+        # _send_cond
+        self._ev_ids: List[str] = []
+        self._ev_names: List[str] = []
+        self._ev_deadline: Optional[float] = None
     
     def connect(self) -> bool:
         """Connect to the MCP server"""
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Messages are small request/response pairs; don't let Nagle delay them
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Set before connect() so the enlarged window is negotiated
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
             self.socket.connect((self.host, self.port))
             self.connected = True
             self.running = True
@@ -40,19 +79,35 @@ class MCPClient:
             self.receive_thread.daemon = True
             self.receive_thread.start()
             
-            logger.info(f"Connected to MCP server at {self.host}:{self.port}")
+            # Start the send thread
+            self.send_thread = threading.Thread(target=self.send_messages)
+            self.send_thread.daemon = True
+            self.send_thread.start()
+            
+            logger.info("Connected to MCP server at %s:%s", self.host, self.port)
             return True
             
         except Exception as e:
-            logger.error(f"Failed to connect to MCP server: {e}")
+            logger.error("Failed to connect to MCP server: %s", e)
             return False
     
     def disconnect(self):
         """Disconnect from the MCP server"""
-        self.running = False
-        self.connected = False
+        with self._send_cond:
+            self.running = False
+            self.connected = False
+            self._send_cond.notify()
+        
+        # Let the send thread flush anything already queued
+        if self.send_thread and self.send_thread is not threading.current_thread():
+            self.send_thread.join(timeout=1.0)
         
         if self.socket:
+            # Shutting down wakes the receive thread out of select()
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             try:
                 self.socket.close()
             except:
@@ -62,65 +117,170 @@ class MCPClient:
     
     def receive_messages(self):
         """Receive and process messages from the server"""
-        buffer = ""
+        buffer = bytearray()
         while self.running and self.connected:
             try:
-                data = self.socket.recv(4096)
-                if not data:
-                    logger.warning("Connection to MCP server closed")
+                # Blocks until data arrives or disconnect() shuts the socket down
+                select.select([self.socket], [], [])
+
+                # Drain everything the kernel has queued before parsing, so a
+                # burst of responses costs one wakeup instead of one each.
+                # The socket stays blocking because the send thread shares
+                # it; a zero-timeout select stands in for EAGAIN.
+                closed = False
+                while True:
+                    n = self.socket.recv_into(self._rxview)
+                    if not n:
+                        closed = True
+                        break
+                    buffer += self._rxview[:n]
+                    # Stop to validate headers before buffering any further
+                    if len(buffer) > MAX_FRAME_SIZE or not select.select([self.socket], [], [], 0)[0]:
+                        break
+
+                self._process_frames(buffer)
+                if closed:
+                    if self.running:
+                        logger.warning("Connection to MCP server closed")
                     self.connected = False
                     break
-
-                buffer += data.decode('utf-8')
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    if not line.strip():
-                        continue
-                    response = json.loads(line)
-                    self.handle_response(response)
                 
             except Exception as e:
                 if self.running:
-                    logger.error(f"Error receiving message: {e}")
+                    logger.error("Error receiving message: %s", e)
                     self.connected = False
                 break
     
-    def handle_response(self, response: Dict[str, Any]):
-        """Handle a response from the server"""
-        if 'type' not in response:
-            logger.warning(f"Received response without type: {response}")
+    def _process_frames(self, buffer: bytearray):
+        """Handle every complete frame in buffer and discard the consumed bytes"""
+        offset = 0
+        # Slicing the view copies each payload once; the view must be
+        # released before the bytearray can be resized
+        with memoryview(buffer) as view:
+            while len(buffer) - offset >= HEADER.size:
+                (length,) = HEADER.unpack_from(buffer, offset)
+                if length > MAX_FRAME_SIZE:
+                    logger.error("Server announced a %s byte frame; dropping connection", length)
+                    self.disconnect()
+                    return
+                start = offset + HEADER.size
+                end = start + length
+                if end > len(buffer):
+                    break
+                self.handle_response(bytes(view[start:end]))
+                offset = end
+        del buffer[:offset]
+    
+    def handle_response(self, payload: bytes):
+        """Handle a framed response from the server"""
+        head, _, body = payload.partition(b'\n')
+        if not head:
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning("Received response without type: %s", loads(body) if body else payload)
             return
             
-        response_type = response['type']
-        logger.info(f"Received {response_type} response")
+        response_type = head.decode('utf-8')
+        logger.info("Received %s response", response_type)
         
-        # Call the appropriate handler if registered
-        if response_type in self.response_handlers:
+        # Call the appropriate handler if registered; responses nobody
+        # listens for are never parsed
+        handler = self.response_handlers.get(response_type)
+        if handler:
             try:
-                self.response_handlers[response_type](response)
+                handler(loads(body))
             except Exception as e:
-                logger.error(f"Error in response handler for {response_type}: {e}")
+                logger.error("Error in response handler for %s: %s", response_type, e)
     
     def register_handler(self, response_type: str, handler: Callable):
         """Register a handler for a specific response type"""
         self.response_handlers[response_type] = handler
-        logger.info(f"Registered handler for {response_type} responses")
+        logger.info("Registered handler for %s responses", response_type)
     
     def send_message(self, message: Dict[str, Any]) -> bool:
-        """Send a message to the MCP server"""
+        """Queue a message for the send thread to deliver to the MCP server"""
         if not self.connected:
             logger.error("Cannot send message: Not connected to server")
             return False
             
         try:
-            data = json.dumps(message) + "\n"
-            self.socket.sendall(data.encode('utf-8'))
-            return True
-            
+            frame = build_frame(message['type'], dumps(message))
         except Exception as e:
-            logger.error(f"Error sending message: {e}")
-            self.connected = False
+            logger.error("Error encoding message: %s", e)
+            return False
+        
+        with self._send_cond:
+            self._send_queue.append(frame)
+            self._send_cond.notify()
+        return True
+    
+    def queue_event(self, command_id: str, command_name: str, flush_immediately: bool = False) -> bool:
+        """Queue a command_executed event to be sent in the next batch"""
+        if not self.connected:
+            logger.error("Cannot send message: Not connected to server")
             return False
+        
+        with self._send_cond:
+            self._ev_ids.append(command_id)
+            self._ev_names.append(command_name)
+            if flush_immediately or len(self._ev_ids) >= MAX_BATCH_EVENTS:
+                self._queue_events()
+                self._send_cond.notify()
+            elif self._ev_deadline is None:
+                self._ev_deadline = time.monotonic() + EVENT_FLUSH_INTERVAL
+                self._send_cond.notify()
+        return True
+    
+    def _queue_events(self):
+        """Move pending events into one command_events frame; hold _send_cond"""
+        message = {
+            'type': 'command_events',
+            'ids': self._ev_ids,
+            'names': self._ev_names
+        }
+        self._ev_ids = []
+        self._ev_names = []
+        self._ev_deadline = None
+        try:
+            self._send_queue.append(build_frame(message['type'], dumps(message)))
+        except Exception as e:
+            logger.error("Error encoding message: %s", e)
+    
+    def send_messages(self):
+        """Write queued frames to the server, coalescing bursts into one syscall"""
+        while True:
+            with self._send_cond:
+                while True:
+                    if self._ev_ids and (not self.running or time.monotonic() >= self._ev_deadline):
+                        self._queue_events()
+                    if self._send_queue or not self.running:
+                        break
+                    timeout = None
+                    if self._ev_deadline is not None:
+                        timeout = max(0.0, self._ev_deadline - time.monotonic())
+                    self._send_cond.wait(timeout)
+                if not self._send_queue:
+                    # Stopped and fully flushed
+                    return
+                count = min(len(self._send_queue), MAX_BATCH_FRAMES)
+                batch = [self._send_queue.popleft() for _ in range(count)]
+            
+            try:
+                self._send_batch(batch)
+            except Exception as e:
+                logger.error("Error sending message: %s", e)
+                self.connected = False
+                return
+    
+    def _send_batch(self, batch: List[bytes]):
+        """Send several frames with a single gathered write where supported"""
+        if len(batch) == 1 or not _HAS_SENDMSG:
+            self.socket.sendall(b''.join(batch))
+            return
+        
+        sent = self.socket.sendmsg(batch)
+        total = sum(len(frame) for frame in batch)
+        if sent < total:
+            self.socket.sendall(b''.join(batch)[sent:])
     
     def execute_fusion_command(self, command: str, params: Dict[str, Any] = None) -> bool:
         """Execute a command in Fusion 360 via the MCP server"""
@@ -143,15 +303,21 @@ class MCPClient:
 
         return self.send_message(message)
 
-    def send_llm_request(self, prompt: str, model: str = 'gpt-3.5-turbo') -> bool:
-        """Send a prompt to the server to be processed by an LLM"""
+    def send_llm_request(self, prompt: str, model: str = 'gpt-3.5-turbo') -> Optional[int]:
+        """Send a prompt to the server to be processed by an LLM
+
+        Returns the request id echoed in every reply to this prompt, or None
+        if the request could not be sent.
+        """
+        request_id = next(self._request_ids)
         message = {
             'type': 'llm_request',
+            'request_id': request_id,
             'prompt': prompt,
             'model': model
         }
 
-        return self.send_message(message)
+        return request_id if self.send_message(message) else None
 
 
 # Example usage
@@ -170,8 +336,24 @@ if __name__ == "__main__":
                 model_info = response.get('data', {})
                 print(f"Model info: {model_info}")
             
+            # LLM output arrives in pieces as it is generated; pieces of
+            # concurrent requests interleave, so buffer them per request id
+            llm_text: Dict[Any, List[str]] = collections.defaultdict(list)
+
+            def llm_chunk_handler(response):
+                llm_text[response.get('request_id')].append(response.get('data', ''))
+
+            def llm_done_handler(response):
+                text = ''.join(llm_text.pop(response.get('request_id'), []))
+                if response.get('status') == 'error':
+                    print(f"LLM error: {response.get('data', {}).get('error')}")
+                else:
+                    print(f"LLM response: {text}")
+            
             client.register_handler('command_result', command_result_handler)
             client.register_handler('model_info', model_info_handler)
+            client.register_handler('llm_chunk', llm_chunk_handler)
+            client.register_handler('llm_done', llm_done_handler)
             
             # Example: Get model info
             client.get_model_info()
@@ -4,7 +4,6 @@ import adsk.cam
 import traceback
 import json
 import threading
-import time
 import os
 import sys
 
@@ -20,7 +19,7 @@ handlers = []
 app = None
 ui = None
 client = None
-stop_flag = False
+stop_event = threading.Event()
 
 # Event handler for the commandExecuted event
 class CommandExecutedHandler(adsk.core.CommandEventHandler):
@@ -29,16 +28,17 @@ class CommandExecutedHandler(adsk.core.CommandEventHandler):
     
     def notify(self, args):
         try:
+            # Bail out before touching the Fusion API when there is no one
+            # to forward the event to
+            if not (client and client.connected):
+                return
+            
             # Get the command that was executed
             eventArgs = adsk.core.CommandEventArgs.cast(args)
             command = eventArgs.command
             
-            if client and client.connected:
-                # Send the command info to the MCP server
-                client.execute_fusion_command('command_executed', {
-                    'command_id': command.id,
-                    'command_name': command.commandDefinition.name
-                })
+            # Queue the command info; bursts reach the server as one batch
+            client.queue_event(command.id, command.commandDefinition.name)
                 
         except:
             if ui:
@@ -51,16 +51,20 @@ class DocumentOpenedHandler(adsk.core.DocumentEventHandler):
     
     def notify(self, args):
         try:
+            # Bail out before touching the Fusion API when there is no one
+            # to forward the event to
+            if not (client and client.connected):
+                return
+            
             # Get the document that was opened
             eventArgs = adsk.core.DocumentEventArgs.cast(args)
             doc = eventArgs.document
             
-            if client and client.connected:
-                # Send document info to the MCP server
-                client.execute_fusion_command('document_opened', {
-                    'document_name': doc.name,
-                    'document_path': doc.path
-                })
+            # Send document info to the MCP server
+            client.execute_fusion_command('document_opened', {
+                'document_name': doc.name,
+                'document_path': doc.path
+            })
                 
         except:
             if ui:
@@ -160,11 +164,10 @@ class MCPConnectionCommandDestroyHandler(adsk.core.CommandEventHandler):
 
 # Worker function for the client communication thread
 def client_worker():
-    global stop_flag, client
+    global client
     
-    while not stop_flag:
-        # Keep the thread alive but don't consume too much CPU
-        time.sleep(0.1)
+    # Block without polling until stop() signals
+    stop_event.wait()
     
     # Disconnect the client when stopping
     if client and client.connected:
@@ -176,7 +179,6 @@ def run(context):
     global app
     global ui
     global client
-    global stop_flag
     
     try:
         # Initialize Fusion 360 API
@@ -221,7 +223,7 @@ def run(context):
         handlers.append(docOpenedHandler)
         
         # Start client worker thread
-        stop_flag = False
+        stop_event.clear()
         client_thread = threading.Thread(target=client_worker)
         client_thread.daemon = True
         client_thread.start()
@@ -236,11 +238,10 @@ def stop(context):
     global handlers
     global app
     global ui
-    global stop_flag
     
     try:
         # Signal the client thread to stop
-        stop_flag = True
+        stop_event.set()
         
         # Clean up command definitions
         ui.commandDefinitions.itemById('MCPConnectionBtn').deleteMe()
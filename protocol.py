@@ -0,0 +1,39 @@
+"""
+Wire format shared by the MCP server, client and Fusion 360 add-in
+"""
+import json
+import struct
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+# orjson works on bytes directly, skipping the str round-trip json needs
+if orjson is not None:
+    dumps = orjson.dumps
+    loads = orjson.loads
+else:
+    def dumps(obj: Any) -> bytes:
+        """Encode obj as compact UTF-8 JSON"""
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    loads = json.loads
+
+# Every message on the wire is prefixed with its length as a 4-byte
+# big-endian unsigned integer. The payload is the message type, a newline,
+# then the JSON body, so receivers can dispatch without parsing the body.
+HEADER = struct.Struct('>I')
+
+# Largest payload a peer may announce; larger headers drop the connection
+# rather than buffering toward 4 GiB
+MAX_FRAME_SIZE = 16 << 20
+
+# Kernel send/receive buffer size; LLM responses can reach tens of KB
+SOCKET_BUFFER_SIZE = 1 << 20
+
+
+def build_frame(msg_type: str, body: bytes) -> bytes:
+    """Build a complete frame from a message type and its encoded body"""
+    head = msg_type.encode('utf-8')
+    return b''.join((HEADER.pack(len(head) + 1 + len(body)), head, b'\n', body))
@@ -1,10 +1,14 @@
-import socket
-import threading
-import json
+import asyncio
+import collections
+import concurrent.futures
+import functools
 import logging
 import os
-import time
-from typing import Dict, Any, List, Optional
+import socket
+import threading
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+from protocol import HEADER, MAX_FRAME_SIZE, SOCKET_BUFFER_SIZE, build_frame, dumps, loads
 
 try:
     import openai
@@ -19,165 +23,297 @@ logging.basicConfig(
 )
 logger = logging.getLogger("Fusion360_MCP")
 
+# Linux-only socket option steering packet processing to a CPU
+_SO_INCOMING_CPU = getattr(socket, 'SO_INCOMING_CPU', None)
+
+# Longest prompt, in characters, forwarded to the LLM
+MAX_PROMPT_LENGTH = 8192
+
+# Number of distinct (model, prompt) completions kept in memory
+LLM_CACHE_SIZE = 1024
+
+
 class MCPServer:
     """
     Master Control Program server for Fusion 360
     Handles communication between clients and Fusion 360
     """
     
-    def __init__(self, host: str = '127.0.0.1', port: int = 8080):
+    def __init__(self, host: str = '127.0.0.1', port: int = 8080, target_cpu: Optional[int] = None):
         self.host = host
         self.port = port
-        self.server_socket = None
-        self.clients: Dict[str, socket.socket] = {}
+        # CPU to pin the event loop and socket processing to, or None to let
+        # the OS schedule freely; only honoured on Linux
+        self.target_cpu = target_cpu
+        self.server: Optional[asyncio.AbstractServer] = None
+        # Keyed by socket file descriptor. Only touched from the event loop
+        # thread, so no lock is needed; other threads must go through
+        # loop.call_soon_threadsafe
+        self.clients: Dict[int, asyncio.StreamWriter] = {}
         self.fusion_data: Dict[str, Any] = {}
         self.running = False
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
+        # One client for the server's lifetime so its HTTP connection pool
+        # keeps TLS sessions to the API alive between requests
+        self._openai = (
+            openai.OpenAI(api_key=self.openai_api_key)
+            if openai and self.openai_api_key else None
+        )
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._dispatch: Dict[str, Callable[[int, bytes], None]] = {
+            'fusion_command': self._do_fusion_command,
+            'command_events': self._do_command_events,
+            'get_model_info': self._do_model_info,
+            'llm_request': self._do_llm_request,
+        }
+        # Model info is static, so encode its response frame once
+        self._model_info_frame = build_frame('model_info', dumps({
+            'status': 'success',
+            'type': 'model_info',
+            'data': self.get_model_info()
+        }))
+        # Completed responses keyed by (model, prompt), oldest use first
+        self._llm_cache: 'collections.OrderedDict[Tuple[str, str], str]' = collections.OrderedDict()
+        self._llm_cache_lock = threading.Lock()
+        # LLM calls block for seconds; keep them off the event loop
+        self._llm_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=8, thread_name_prefix='mcp-llm'
+        )
     
     def start(self):
-        """Start the MCP server"""
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
+        """Start the MCP server and block until it is stopped"""
         try:
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            self.running = True
-            logger.info(f"MCP Server started on {self.host}:{self.port}")
-            
-            # Start accepting client connections
-            accept_thread = threading.Thread(target=self.accept_connections)
-            accept_thread.daemon = True
-            accept_thread.start()
-            
-            # Main server loop
-            try:
-                while self.running:
-                    time.sleep(0.1)
-            except KeyboardInterrupt:
-                self.stop()
-                
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            self.stop()
         except Exception as e:
-            logger.error(f"Error starting MCP server: {e}")
+            logger.error("Error starting MCP server: %s", e)
             self.stop()
-    
-    def accept_connections(self):
-        """Accept incoming client connections"""
-        while self.running:
+
+    async def _serve(self):
+        """Accept and serve all clients from a single event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._pin_to_cpu()
+        self.server = await asyncio.start_server(
+            self._handle,
+            sock=self._create_listen_socket(),
+            backlog=socket.SOMAXCONN
+        )
+        self.running = True
+        logger.info("MCP Server started on %s:%s", self.host, self.port)
+
+        async with self.server:
             try:
-                client_socket, addr = self.server_socket.accept()
-                logger.info(f"New connection from {addr}")
-                
-                # Start a new thread to handle the client
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, addr)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-                
-            except Exception as e:
-                if self.running:
-                    logger.error(f"Error accepting connection: {e}")
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
     
-    def handle_client(self, client_socket: socket.socket, addr):
+    def _pin_to_cpu(self):
+        """Keep the event loop thread on target_cpu for cache locality
+
+        Worker threads started afterwards inherit the affinity.
+        """
+        if self.target_cpu is None or not hasattr(os, 'sched_setaffinity'):
+            return
+        try:
+            os.sched_setaffinity(0, {self.target_cpu})
+            logger.info("Pinned MCP Server to CPU %s", self.target_cpu)
+        except OSError as e:
+            logger.warning("Could not pin MCP Server to CPU %s: %s", self.target_cpu, e)
+
+    def _create_listen_socket(self) -> socket.socket:
+        """Create the listening socket with options accepted sockets inherit"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Buffer sizes must be set before listen() to affect the TCP window
+        # advertised by accepted connections
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.bind((self.host, self.port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """Handle communication with a connected client"""
-        client_id = f"{addr[0]}:{addr[1]}"
-        self.clients[client_id] = client_socket
+        addr = writer.get_extra_info('peername')
+        sock = writer.get_extra_info('socket')
+        # The descriptor is a cheap, unique key while the connection is open;
+        # the address is only formatted when logged
+        client_id = sock.fileno()
+        # Messages are small request/response pairs; don't let Nagle delay them
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.target_cpu is not None and _SO_INCOMING_CPU is not None:
+            # Ask the kernel to process this connection's packets on our CPU
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, _SO_INCOMING_CPU, self.target_cpu)
+            except OSError:
+                pass
+        self.clients[client_id] = writer
+        logger.info("New connection from %s:%s (client %s)", addr[0], addr[1], client_id)
         
         try:
-            buffer = ""
             while self.running:
-                data = client_socket.recv(4096)
-                if not data:
+                header = await reader.readexactly(HEADER.size)
+                (length,) = HEADER.unpack_from(header)
+                if length > MAX_FRAME_SIZE:
+                    logger.warning("Client %s announced a %s byte frame; dropping connection",
+                                   client_id, length)
                     break
 
-                buffer += data.decode('utf-8')
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    if not line.strip():
-                        continue
-                    message = json.loads(line)
-                    self.process_message(client_id, message)
-                
+                payload = await reader.readexactly(length)
+                self.process_message(client_id, payload)
+                await writer.drain()
+
+        except asyncio.IncompleteReadError:
+            # Client closed the connection
+            pass
+
         except Exception as e:
-            logger.error(f"Error handling client {client_id}: {e}")
+            logger.error("Error handling client %s (%s:%s): %s", client_id, addr[0], addr[1], e)
         
         finally:
             # Clean up when client disconnects
-            if client_id in self.clients:
+            if self.clients.get(client_id) is writer:
                 del self.clients[client_id]
-            try:
-                client_socket.close()
-            except:
-                pass
-            logger.info(f"Client {client_id} disconnected")
+            writer.close()
+            logger.info("Client %s (%s:%s) disconnected", client_id, addr[0], addr[1])
     
-    def process_message(self, client_id: str, message: Dict[str, Any]):
-        """Process a message from a client"""
-        if 'type' not in message:
+    def register_handler(self, msg_type: str, handler: Callable[[int, bytes], None]):
+        """Register a handler for a message type
+
+        The handler receives the client id and the still-encoded JSON body.
+        """
+        self._dispatch[msg_type] = handler
+
+    def process_message(self, client_id: int, payload: bytes):
+        """Process a framed message from a client"""
+        head, sep, body = payload.partition(b'\n')
+        if not sep or not head:
             self.send_response(client_id, {'status': 'error', 'message': 'Missing message type'})
             return
             
-        msg_type = message['type']
-        logger.info(f"Received {msg_type} message from {client_id}")
+        msg_type = head.decode('utf-8')
+        logger.info("Received %s message from client %s", msg_type, client_id)
         
-        if msg_type == 'fusion_command':
-            # Handle Fusion 360 command
-            command = message.get('command')
-            params = message.get('params', {})
-            
-            # TODO: Implement actual Fusion 360 API integration
-            result = self.execute_fusion_command(command, params)
-            self.send_response(client_id, {
-                'status': 'success',
-                'type': 'command_result',
-                'command': command,
-                'result': result
-            })
-            
-        elif msg_type == 'get_model_info':
-            # Return information about the current model
-            model_info = self.get_model_info()
+        handler = self._dispatch.get(msg_type)
+        if handler:
+            handler(client_id, body)
+        else:
             self.send_response(client_id, {
-                'status': 'success',
-                'type': 'model_info',
-                'data': model_info
+                'status': 'error',
+                'message': f'Unknown message type: {msg_type}'
             })
 
-        elif msg_type == 'llm_request':
-            prompt = message.get('prompt', '')
-            model = message.get('model', 'gpt-3.5-turbo')
-            result = self.handle_llm_request(prompt, model)
-            self.send_response(client_id, {
-                'status': 'success' if 'error' not in result else 'error',
-                'type': 'llm_result',
-                'data': result
+    # Message handlers only parse the body when they read fields from it
+
+    def _do_fusion_command(self, client_id: int, body: bytes):
+        """Handle Fusion 360 command"""
+        message = loads(body)
+        command = message.get('command')
+        params = message.get('params', {})
+        
+        # TODO: Implement actual Fusion 360 API integration
+        result = self.execute_fusion_command(command, params)
+        self.send_response(client_id, {
+            'status': 'success',
+            'type': 'command_result',
+            'command': command,
+            'result': result
+        })
+
+    def _do_command_events(self, client_id: int, body: bytes):
+        """Handle a batch of command_executed events sent column-wise"""
+        message = loads(body)
+        ids = message.get('ids', [])
+        names = message.get('names', [])
+        for command_id, command_name in zip(ids, names):
+            self.execute_fusion_command('command_executed', {
+                'command_id': command_id,
+                'command_name': command_name
             })
+        self.send_response(client_id, {
+            'status': 'success',
+            'type': 'command_result',
+            'command': 'command_events',
+            'result': {'executed': True, 'count': min(len(ids), len(names))}
+        })
 
-        else:
-            self.send_response(client_id, {
-                'status': 'error',
-                'message': f'Unknown message type: {msg_type}'
+    def _do_model_info(self, client_id: int, body: bytes):
+        """Return information about the current model; takes no parameters"""
+        self.clients[client_id].write(self._model_info_frame)
+
+    def _do_llm_request(self, client_id: int, body: bytes):
+        """Hand an LLM prompt to the worker pool, streaming output back"""
+        message = loads(body)
+        prompt = message.get('prompt', '')
+        model = message.get('model', 'gpt-3.5-turbo')
+        # Requests finish in any order; echo the caller's id so replies can
+        # be matched to the prompt they answer
+        request_id = message.get('request_id')
+        writer = self.clients[client_id]
+
+        def on_chunk(delta: str):
+            # Runs on a worker thread; the writer belongs to the loop
+            self._loop.call_soon_threadsafe(self._send_if_connected, client_id, writer, {
+                'status': 'success',
+                'type': 'llm_chunk',
+                'request_id': request_id,
+                'data': delta
             })
+
+        future = self._loop.run_in_executor(
+            self._llm_pool, self.handle_llm_request, prompt, model, on_chunk
+        )
+        future.add_done_callback(
+            functools.partial(self._send_llm_done, client_id, writer, request_id)
+        )
     
-    def send_response(self, client_id: str, response: Dict[str, Any]):
+    def _send_llm_done(self, client_id: int, writer: asyncio.StreamWriter, request_id: Any,
+                       future: asyncio.Future):
+        """Tell the client a streamed LLM request has finished"""
+        if future.cancelled():
+            # Server shut down while we waited
+            return
+
+        exc = future.exception()
+        if exc is not None:
+            logger.error("LLM request failed: %s", exc)
+            result = {'error': str(exc)}
+        else:
+            result = future.result()
+
+        if 'error' in result:
+            response = {'status': 'error', 'type': 'llm_done', 'request_id': request_id, 'data': result}
+        else:
+            response = {'status': 'success', 'type': 'llm_done', 'request_id': request_id, 'data': {}}
+        self._send_if_connected(client_id, writer, response)
+
+    def _send_if_connected(self, client_id: int, writer: asyncio.StreamWriter, response: Dict[str, Any]):
+        """Send a response unless the client that asked for it has gone away"""
+        if self.clients.get(client_id) is writer:
+            self.send_response(client_id, response)
+
+    def send_response(self, client_id: int, response: Dict[str, Any]):
         """Send a response to a client"""
         if client_id not in self.clients:
-            logger.warning(f"Attempted to send response to unknown client {client_id}")
+            logger.warning("Attempted to send response to unknown client %s", client_id)
             return
             
         try:
-            data = json.dumps(response) + "\n"
-            self.clients[client_id].sendall(data.encode('utf-8'))
+            frame = build_frame(response.get('type', ''), dumps(response))
+            self.clients[client_id].write(frame)
         except Exception as e:
-            logger.error(f"Error sending response to {client_id}: {e}")
+            logger.error("Error sending response to client %s: %s", client_id, e)
             
     def execute_fusion_command(self, command: str, params: Dict[str, Any]) -> Dict[str, Any]:
         """Execute a command in Fusion 360"""
         # This is a placeholder. In a real implementation, this would
         # interact with the Fusion 360 API to execute commands
-        logger.info(f"Executing Fusion command: {command} with params: {params}")
+        logger.info("Executing Fusion command: %s with params: %s", command, params)
         
         # Mock response for demonstration
         return {
@@ -187,7 +323,11 @@ class MCPServer:
         }
     
     def get_model_info(self) -> Dict[str, Any]:
-        """Get information about the current model in Fusion 360"""
+        """Get information about the current model in Fusion 360
+
+        The result is encoded once in __init__; rebuild _model_info_frame if
+        this starts returning live data.
+        """
         # This is a placeholder. In a real implementation, this would
         # retrieve actual model data from Fusion 360
         return {
@@ -199,47 +339,92 @@ class MCPServer:
             ]
         }
 
-    def handle_llm_request(self, prompt: str, model: str) -> Dict[str, Any]:
-        """Send a prompt to an LLM and return the response"""
+    def handle_llm_request(self, prompt: str, model: str,
+                           on_chunk: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        """Send a prompt to an LLM and return the response
+
+        If on_chunk is given it is called with each piece of the response
+        as it is generated.
+        """
         if openai is None:
             return {'error': 'openai package not installed'}
 
         if not self.openai_api_key:
             return {'error': 'OPENAI_API_KEY not configured'}
 
-        try:
-            openai.api_key = self.openai_api_key
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=[{'role': 'user', 'content': prompt}]
-            )
-            content = response['choices'][0]['message']['content']
+        if not isinstance(prompt, str) or not isinstance(model, str):
+            return {'error': 'prompt and model must be strings'}
+
+        if len(prompt) > MAX_PROMPT_LENGTH:
+            return {'error': f'Prompt exceeds {MAX_PROMPT_LENGTH} characters'}
+
+        # Identical prompts are answered from memory instead of the API
+        key = (model, prompt)
+        with self._llm_cache_lock:
+            content = self._llm_cache.get(key)
+            if content is not None:
+                self._llm_cache.move_to_end(key)
+        if content is not None:
+            if on_chunk:
+                on_chunk(content)
             return {'response': content}
+
+        try:
+            content = self._complete(model, prompt, on_chunk)
         except Exception as exc:
-            logger.error(f"LLM request failed: {exc}")
+            logger.error("LLM request failed: %s", exc)
             return {'error': str(exc)}
+
+        with self._llm_cache_lock:
+            self._llm_cache[key] = content
+            if len(self._llm_cache) > LLM_CACHE_SIZE:
+                self._llm_cache.popitem(last=False)
+        return {'response': content}
+
+    def _complete(self, model: str, prompt: str,
+                  on_chunk: Optional[Callable[[str], None]] = None) -> str:
+        """Run a single streamed chat completion and return the full text"""
+        stream = self._openai.chat.completions.create(
+            model=model,
+            messages=[{'role': 'user', 'content': prompt}],
+            stream=True
+        )
+        parts = []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                if on_chunk:
+                    on_chunk(delta)
+        return ''.join(parts)
     
     def stop(self):
-        """Stop the MCP server"""
+        """Stop the MCP server; safe to call from any thread"""
         self.running = False
-        
-        # Close all client connections
-        for client_id, client_socket in self.clients.items():
-            try:
-                client_socket.close()
-            except:
-                pass
-        self.clients.clear()
-        
-        # Close server socket
-        if self.server_socket:
+        self._llm_pool.shutdown(wait=False)
+
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
             try:
-                self.server_socket.close()
-            except:
+                loop.call_soon_threadsafe(self._close)
+            except RuntimeError:
+                # Loop closed between the check and the call
                 pass
             
         logger.info("MCP Server stopped")
 
+    def _close(self):
+        """Close the listener and all client connections on the event loop"""
+        if self.server:
+            self.server.close()
+
+        writers = list(self.clients.values())
+        self.clients.clear()
+        for writer in writers:
+            writer.close()
+
 
 if __name__ == "__main__":
     # Create and start the MCP server